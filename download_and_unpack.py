@@ -1,5 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 import os
 from pathlib import Path
+import shutil
+from typing import Optional, Tuple
 import zipfile
 
 import requests
@@ -12,32 +16,177 @@ this_file = Path(__file__)
 this_dir = this_file.parent
 zip_file_path = this_dir / "data_zip" / "prg.zip"
 xml_dir = this_dir / "data_xml"
+xml_split_dir = this_dir / "data_xml_split"
+
+COPY_BUFFER_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_WORKERS = 8
+
+ROOT_TAG = "gml:FeatureCollection"
+ROW_TAG = "prg-ad:PRG_PunktAdresowy"
+ROWS_PER_SPLIT_FILE = 50_000
+
+
+def get_ranged_download_info(url: str) -> Optional[Tuple[int, str]]:
+    # returns file size and its version validator if server allows downloading it in parts, None otherwise
+    if not hasattr(os, "pwrite"):
+        return None
+    r = requests.head(url, allow_redirects=True)
+    if not r.ok or r.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    content_length = r.headers.get("Content-Length")
+    if content_length is None or int(content_length) == 0:
+        return None
+    # If-Range needs strong ETag or Last-Modified date, without them we can't make sure
+    # that all parts come from the same version of the file
+    etag = r.headers.get("ETag")
+    validator = etag if etag is not None and not etag.startswith("W/") else r.headers.get("Last-Modified")
+    if validator is None:
+        return None
+    return int(content_length), validator
+
+
+def download_range(url: str, fd: int, start: int, end: int, validator: str) -> None:
+    # with If-Range server sends the whole file instead of the range if file changed since HEAD request
+    headers = {"Range": f"bytes={start}-{end}", "If-Range": validator}
+    with requests.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise ValueError(
+                f"Server didn't return bytes {start}-{end} (file changed during download?), got status: {r.status_code}"
+            )
+        offset = start
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            view = memoryview(chunk)
+            while view:  # pwrite is allowed to write less than asked
+                written = os.pwrite(fd, view, offset)
+                offset += written
+                view = view[written:]
+    if offset != end + 1:
+        raise ValueError(f"Expected to download bytes {start}-{end} but got only up to {offset - 1}")
+
+
+def download_file_in_parts(url: str, to: Path, size: int, validator: str) -> None:
+    part_size = -(-size // DOWNLOAD_WORKERS)  # ceil division
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    fd = os.open(to, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.truncate(fd, size)
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures = [executor.submit(download_range, url, fd, start, end, validator) for start, end in ranges]
+            for future in futures:
+                future.result()  # reraise exceptions from workers
+    finally:
+        os.close(fd)
 
 
 def download_file(url: str, to: Path) -> None:
     print("Downloading data from:", url, "to file:", to)
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(to, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192): 
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                #if chunk: 
-                f.write(chunk)
+    ranged_download_info = get_ranged_download_info(url)
+    if ranged_download_info is not None:
+        size, validator = ranged_download_info
+        print(f"Server supports range requests, downloading {size} bytes in {DOWNLOAD_WORKERS} parts.")
+        download_file_in_parts(url=url, to=to, size=size, validator=validator)
+    else:
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            with open(to, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
     print("Finished downloading.")
 
 
+def extract_member(zip_file_path: Path, member_name: str, to: Path) -> None:
+    new_name = member_name.split("_")[-1:][0]
+    print(f"Extracting {member_name} to {new_name}")
+    # every worker needs its own handle, ZipFile can't be shared between processes
+    with zipfile.ZipFile(zip_file_path, "r") as zip:
+        # stream member straight into target directory instead of extracting with nested path,
+        # temporary name makes sure we never leave a partially written xml file under its final name
+        part_path = to / f"{new_name}.part"
+        with zip.open(member_name) as src, open(part_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, length=COPY_BUFFER_SIZE)
+        os.replace(part_path, to / new_name)
+
+
 def unzip_files(zip_file_path: Path, to: Path) -> None:
     print("Unpacking zip file:", zip_file_path)
+    to.mkdir(parents=True, exist_ok=True)
     with zipfile.ZipFile(zip_file_path, "r") as zip:
-        for zf in zip.filelist:
-            new_name = zf.filename.split("_")[-1:][0]
-            print(f"Extracting {zf.filename} to {new_name}")
-            zip.extract(zf, xml_dir)
-            os.rename(xml_dir / zf.filename, xml_dir / new_name)
+        member_names = [zf.filename for zf in zip.filelist if not zf.is_dir()]
+    # members are independent so decompress them on all cores
+    with Pool(min(os.cpu_count() or 1, max(1, len(member_names)))) as pool:
+        pool.starmap(extract_member, [(zip_file_path, name, to) for name in member_names])
     print("Finished unpacking zip file.")
 
 
+def split_xml_file(path: Path, to: Path, rows_per_file: int) -> None:
+    # spark-xml reads whole file in one partition so we split big files into many smaller ones.
+    # it's done on text level because spark-xml matches tag names with namespace prefixes literally
+    # and xml libraries would rewrite the prefixes, it's also much faster than building element trees
+    print(f"Splitting {path} into files with {rows_per_file} addresses each")
+    root_start = f"<{ROOT_TAG}"
+    row_start = f"<{ROW_TAG}"
+    row_end = f"</{ROW_TAG}>"
+    footer = f"</{ROOT_TAG}>\n"
+    with open(path, "r", encoding="utf-8") as src:
+        # header is everything up to the end of root start tag so it keeps xml declaration and namespaces
+        buffer = ""
+        while buffer.find(root_start) == -1 or buffer.find(">", buffer.find(root_start)) == -1:
+            block = src.read(COPY_BUFFER_SIZE)
+            if not block:
+                raise ValueError(f"Couldn't find {ROOT_TAG} element in: {path}")
+            buffer += block
+        pos = buffer.find(">", buffer.find(root_start)) + 1
+        header = buffer[:pos] + "\n"
+
+        dst = None
+        file_index = 0
+        rows_in_file = 0
+        while True:
+            start = buffer.find(row_start, pos)
+            end = buffer.find(row_end, start) if start != -1 else -1
+            if end == -1:  # need more data to get whole row
+                block = src.read(COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                buffer = buffer[start if start != -1 else max(pos, len(buffer) - len(row_start)):] + block
+                pos = 0
+                continue
+            end += len(row_end)
+            if dst is None:
+                dst = open(to / f"{path.stem}_{file_index:05d}.xml", "w", encoding="utf-8")
+                dst.write(header)
+            dst.write(buffer[start:end])
+            dst.write("\n")
+            pos = end
+            rows_in_file += 1
+            if rows_in_file == rows_per_file:
+                dst.write(footer)
+                dst.close()
+                dst = None
+                file_index += 1
+                rows_in_file = 0
+        if dst is not None:
+            dst.write(footer)
+            dst.close()
+
+
+def split_xml_files(from_dir: Path, to: Path, rows_per_file: int) -> None:
+    print("Splitting xml files from:", from_dir, "to:", to)
+    to.mkdir(parents=True, exist_ok=True)
+    for old_file in to.glob("*.xml"):  # leftovers from previous run would be read as duplicates
+        old_file.unlink()
+    paths = sorted(from_dir.glob("*.xml"))
+    with Pool(min(os.cpu_count() or 1, max(1, len(paths)))) as pool:
+        pool.starmap(split_xml_file, [(path, to, rows_per_file) for path in paths])
+    print("Finished splitting xml files.")
+
+
 if __name__ == "__main__":
     download_file(url=GML_URL, to=zip_file_path)
     unzip_files(zip_file_path, xml_dir)
+    split_xml_files(from_dir=xml_dir, to=xml_split_dir, rows_per_file=ROWS_PER_SPLIT_FILE)
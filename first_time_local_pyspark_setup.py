@@ -1,17 +1,37 @@
+from pathlib import Path
+import shutil
+from urllib.parse import unquote, urlparse
+
 from sedona.spark import SedonaContext
 
+from process_gml import SPARK_PACKAGES, local_jars_dir, local_jars_marker_path
+
 
 config = (
     SedonaContext
     .builder()
-    .config(
-        "spark.jars.packages",
-        ",".join([
-            "org.apache.sedona:sedona-spark-3.5_2.12:1.6.0",
-            "org.datasyslab:geotools-wrapper:1.6.0-28.2",
-            "com.databricks:spark-xml_2.12:0.18.0",
-        ]))
+    .config("spark.jars.packages", ",".join(SPARK_PACKAGES))
     .getOrCreate()
 )
 
 sedona = SedonaContext.create(config)
+
+# keep jars resolved for our packages (including transitive dependencies) so later runs can use them
+# without ivy resolution, spark-submit puts their local paths in spark.jars
+resolved_jars = [
+    Path(unquote(urlparse(jar).path))
+    for jar in sedona.conf.get("spark.jars", "").split(",")
+    if jar.strip()
+]
+if not resolved_jars:
+    raise ValueError("Spark didn't resolve any jars for packages: " + ",".join(SPARK_PACKAGES))
+# marker is removed first so an interrupted copy makes get_sedona_context fall back to ivy resolution
+local_jars_marker_path.unlink(missing_ok=True)
+local_jars_dir.mkdir(parents=True, exist_ok=True)
+for old_jar in local_jars_dir.glob("*.jar"):
+    old_jar.unlink()
+for jar in resolved_jars:
+    print(f"Copying {jar} to {local_jars_dir}")
+    shutil.copy2(jar, local_jars_dir / jar.name)
+# get_sedona_context uses local jars only if they were resolved for current package list
+local_jars_marker_path.write_text(",".join(SPARK_PACKAGES))
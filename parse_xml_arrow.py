@@ -0,0 +1,129 @@
+from datetime import date, datetime, timezone
+from multiprocessing import Pool
+import os
+from pathlib import Path
+from typing import List, Optional
+
+from lxml import etree
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Parses PRG address xml files straight to parquet files using lxml and pyarrow without Spark.
+# Every file is parsed in a separate process, parsed addresses are written in record batches.
+
+this_file = Path(__file__)
+this_dir = this_file.parent
+xml_split_dir = this_dir / "data_xml_split"
+parsed_xml_dir = this_dir / "data_geoparquet" / "xml"
+
+ROW_TAG = "{*}PRG_PunktAdresowy"
+ROWS_PER_BATCH = 100_000
+
+# local names (without namespace) of elements that we need from every address and their types
+FIELDS = {
+    "przestrzenNazw": pa.string(),  # namespace in IIP (Spatial Information Infrastructure)
+    "lokalnyId": pa.string(),  # unique object identifier
+    "wersjaId": pa.timestamp("us", tz="UTC"),  # version id (timestamp)
+    "poczatekWersjiObiektu": pa.date32(),  # object beginning
+    "koniecWersjiObiektu": pa.date32(),  # object end
+    "waznyOd": pa.date32(),  # valid since
+    "waznyDo": pa.date32(),  # valid to
+    "jednostkaAdmnistracyjna": pa.list_(pa.string()),  # administrative units
+    "miejscowosc": pa.string(),  # city/village
+    "czescMiejscowosci": pa.string(),  # part of city/village
+    "ulica": pa.string(),  # street name
+    "numerPorzadkowy": pa.string(),  # housenumber
+    "kodPocztowy": pa.string(),  # postal code
+    "status": pa.string(),  # status (existing, being built, planned)
+}
+# gml:pos is "y x" in EPSG:2180, we store it as separate numeric columns
+POSITION_FIELDS = {
+    "x": pa.float64(),
+    "y": pa.float64(),
+}
+schema = pa.schema({**FIELDS, **POSITION_FIELDS})
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    # timestamps are stored as UTC instants like in spark output, values without offset are taken as UTC
+    return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed.astimezone(timezone.utc)
+
+
+def parse_date(value: Optional[str]) -> Optional[date]:
+    return None if value is None else date.fromisoformat(value[:10])
+
+
+PARSERS = {
+    pa.timestamp("us", tz="UTC"): parse_timestamp,
+    pa.date32(): parse_date,
+}
+
+
+def new_columns() -> dict:
+    return {name: [] for name in schema.names}
+
+
+def append_address(columns: dict, element: etree._Element) -> None:
+    row = {name: None for name in FIELDS}
+    row["jednostkaAdmnistracyjna"] = []
+    pos = None
+    for child in element.iter():
+        if not isinstance(child.tag, str) or child.text is None:  # skip comments and empty elements
+            continue
+        name = child.tag.rsplit("}", 1)[-1]
+        if name == "jednostkaAdmnistracyjna":
+            row[name].append(child.text)
+        elif name == "pos":
+            pos = child.text
+        elif name in row:
+            row[name] = child.text
+    if not row["jednostkaAdmnistracyjna"]:
+        row["jednostkaAdmnistracyjna"] = None  # spark-xml gives null instead of empty array
+    for name, value in row.items():
+        parser = PARSERS.get(FIELDS[name])
+        columns[name].append(parser(value) if parser is not None else value)
+    # like in spark we take first two coordinates and don't fail on blank or 3D positions
+    tokens = pos.split() if pos is not None else []
+    y, x = (tokens[0], tokens[1]) if len(tokens) >= 2 else (None, None)
+    columns["x"].append(None if x is None else float(x))
+    columns["y"].append(None if y is None else float(y))
+
+
+def parse_xml_file(path: Path, to: Path) -> int:
+    print("Parsing xml file:", path)
+    num_rows = 0
+    columns = new_columns()
+    with pq.ParquetWriter(to / f"{path.stem}.parquet", schema, compression="zstd") as writer:
+        for _, element in etree.iterparse(str(path), events=("end",), tag=ROW_TAG, huge_tree=True):
+            append_address(columns=columns, element=element)
+            # free memory used by already parsed addresses
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            if len(columns["x"]) == ROWS_PER_BATCH:
+                writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+                num_rows += ROWS_PER_BATCH
+                columns = new_columns()
+        if columns["x"]:
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+            num_rows += len(columns["x"])
+    return num_rows
+
+
+def parse_xml_files(paths: List[Path], to: Path) -> int:
+    print(f"Parsing {len(paths)} xml files to:", to)
+    to.mkdir(parents=True, exist_ok=True)
+    for old_file in to.glob("*.parquet"):
+        old_file.unlink()
+    with Pool(min(os.cpu_count() or 1, max(1, len(paths)))) as pool:
+        num_rows = sum(pool.starmap(parse_xml_file, [(path, to) for path in paths]))
+    print(f"Finished parsing xml files, got {num_rows} addresses.")
+    return num_rows
+
+
+if __name__ == "__main__":
+    parse_xml_files(paths=sorted(xml_split_dir.glob("*.xml")), to=parsed_xml_dir)
@@ -1,8 +1,11 @@
 import json
+from copy import deepcopy
 from pathlib import Path
 from typing import List, Union
 from sys import argv
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sedona.spark import SedonaContext
 from pyspark.sql import SparkSession, DataFrame
 from pyspark.sql.types import StructType, StructField, StringType, TimestampType, ArrayType, DateType
@@ -11,13 +14,52 @@ from pyspark.sql import functions as f
 
 this_file = Path(__file__)
 this_dir = this_file.parent
-xml_dir = this_dir / "data_xml"
+xml_split_dir = this_dir / "data_xml_split"
 geoparquet_dir = this_dir / "data_geoparquet" / "files"
+merged_geoparquet_path = this_dir / "data_geoparquet" / "addresses.parquet"
+local_jars_dir = Path.home() / ".sedona_jars"  # filled by first_time_local_pyspark_setup.py
+local_jars_marker_path = local_jars_dir / "packages.txt"  # packages that jars in local_jars_dir were resolved for
 
 MODE_OVERTURE = "overture"
 MODE_OSMPOLAND = "osmpoland"
 MODES = {MODE_OVERTURE, MODE_OSMPOLAND}
 
+SPARK_PACKAGES = [
+    "org.apache.sedona:sedona-spark-3.5_2.12:1.6.0",
+    "org.datasyslab:geotools-wrapper:1.6.0-28.2",
+    "com.databricks:spark-xml_2.12:0.18.0",
+]
+
+MAX_RECORDS_PER_FILE = 1_000_000
+# logical plan nodes and expressions which evaluate python code,
+# every row going through them is serialized between JVM and python
+PYTHON_PLAN_NODES = {
+    "BatchEvalPython",
+    "ArrowEvalPython",
+    "PythonMapInArrow",
+    "MapInArrow",  # PythonMapInArrow was renamed in Spark 4
+    "MapInPandas",
+    "FlatMapGroupsInPandas",
+    "FlatMapGroupsInArrow",
+    "FlatMapGroupsInPandasWithState",
+    "FlatMapCoGroupsInPandas",
+    "FlatMapCoGroupsInArrow",
+}
+# grouped aggregate and window pandas udfs stay as these expressions inside Aggregate and Window nodes
+PYTHON_EXPRESSIONS = {
+    "PythonUDF",
+    "PythonUDAF",
+}
+
+GEOHASH_PRECISION = 5  # cells are roughly 5x5 km
+
+PARQUET_ROW_GROUP_SIZE = 256 * 1024 * 1024
+PARQUET_PAGE_SIZE = 1024 * 1024
+PARQUET_DICTIONARY_PAGE_SIZE = 2 * 1024 * 1024
+
+# lifecycle values are full timestamps in xml so they are read as timestamps
+# but written as dates (see select_cols_for_osmpoland), day granularity is enough and dates take half the space,
+# version id stays a timestamp because there can be many versions of an object in one day
 schema = StructType([
     StructField("gml:identifier", StringType()),  # gml id
     StructField("prg-ad:idIIP", StructType([
@@ -53,21 +95,46 @@ schema = StructType([
     ])),  # identifier in municipality system
 ])
 
+# top level fields used by each mode, spark-xml doesn't prune columns so we leave the rest out of the read schema
+REQUIRED_TOP_FIELDS = {
+    MODE_OVERTURE: [
+        # "gml:identifier" - we're gonna use IIP identifier
+        "prg-ad:idIIP",
+        "prg-ad:cyklZycia",
+        "prg-ad:waznyDo",
+        "prg-ad:jednostkaAdmnistracyjna",
+        "prg-ad:miejscowosc",
+        "prg-ad:czescMiejscowosci",
+        "prg-ad:ulica",
+        "prg-ad:numerPorzadkowy",
+        "prg-ad:kodPocztowy",
+        "prg-ad:status",
+        "prg-ad:pozycja",
+        # "prg-ad:komponent" - we don't need to join to any other records
+        # "prg-ad:obiektEMUiA"
+    ],
+    MODE_OSMPOLAND: schema.fieldNames(),
+}
+
+
+def get_schema(mode: str) -> StructType:
+    return StructType([field for field in schema.fields if field.name in REQUIRED_TOP_FIELDS[mode]])
+
 
 def get_sedona_context() -> SparkSession:
-    config = (
+    builder = (
         SedonaContext
         .builder()
-        .config("spark.sql.parquet.datetimeRebaseModeInWrite", "CORRECTED")  # to allow writing old timestamps which apparently is needed? 
-        .config(
-            "spark.jars.packages",
-            ",".join([
-                "org.apache.sedona:sedona-spark-3.5_2.12:1.6.0",
-                "org.datasyslab:geotools-wrapper:1.6.0-28.2",
-                "com.databricks:spark-xml_2.12:0.18.0",
-            ]))
-        .getOrCreate()
+        .config("spark.sql.parquet.datetimeRebaseModeInWrite", "CORRECTED")  # to allow writing old dates which apparently is needed? 
     )
+    local_jars = sorted(local_jars_dir.glob("*.jar"))
+    local_jars_packages = local_jars_marker_path.read_text().strip() if local_jars_marker_path.exists() else None
+    if local_jars and local_jars_packages == ",".join(SPARK_PACKAGES):
+        # skip ivy resolution which connects to maven repositories on every run
+        builder = builder.config("spark.jars", ",".join(jar.as_posix() for jar in local_jars))
+    else:
+        builder = builder.config("spark.jars.packages", ",".join(SPARK_PACKAGES))
+    config = builder.getOrCreate()
     sedona = SedonaContext.create(config)
 
     driver_mem = sedona.conf.get("spark.driver.memory", default=None)
@@ -80,7 +147,7 @@ def get_sedona_context() -> SparkSession:
     return sedona
 
 
-def read_xml(spark: SparkSession, path: Union[str, List[str]]) -> DataFrame:
+def read_xml(spark: SparkSession, path: Union[str, List[str]], schema: StructType) -> DataFrame:
     return (
         spark.read
         .format("com.databricks.spark.xml")
@@ -90,7 +157,7 @@ def read_xml(spark: SparkSession, path: Union[str, List[str]]) -> DataFrame:
         # there's also administrative units (prg-ad:PRG_JednostkaAdministracyjnaNazwa), places (prg-ad:PRG_MiejscowoscNazwa), and streets (prg-ad:PRG_UlicaNazwa)
         # but they are not needed to get addresses
         .option("rowTag", "prg-ad:PRG_PunktAdresowy")
-        .option("inferSchema", "false")  # we specify schema manually above
+        .option("inferSchema", "false")  # we specify schema manually
         .option("ignoreNamespace", "false")
         .option("attributePrefix", "_")
         .load(path)
@@ -109,32 +176,32 @@ def remove_planned_addresses(df: DataFrame) -> DataFrame:
     return df.where(f.col("prg-ad:status") != f.lit("prognozowany"))
 
 
-def remove_unneeded_ids(df: DataFrame) -> DataFrame:
-    return df.drop(
-        "gml:identifier",  # we're gonna use IIP identifier
-        "prg-ad:komponent",  # we don't need to join to any other records
-        "prg-ad:obiektEMUiA",
-    )
+def remove_objects_without_position(df: DataFrame) -> DataFrame:
+    return df.where(f.col("prg-ad:pozycja.gml:Point.gml:pos").isNotNull())
 
 
 def parse_point_geometry(df: DataFrame) -> DataFrame:
-    # ST_GeomFromGML couldn't parse the geometry so we're doing that manually which is simple enough for points
+    # ST_GeomFromGML couldn't parse the geometry so we're doing that manually which is simple enough for points,
+    # gml:pos is "y x" so we build the point from swapped coordinates instead of going through WKT and flipping,
+    # position is split once in a separate column so it's tokenized only once per row
     return (
         df
+        # trim and split on any whitespace run so extra spaces or newlines don't produce empty coordinates,
+        # f.trim removes only spaces so leading/trailing whitespace is stripped with a regex
+        .withColumn("_pos", f.split(f.regexp_replace(f.col("prg-ad:pozycja.gml:Point.gml:pos"), r"^\s+|\s+$", ""), r"\s+"))
         .withColumn("geometry", f.expr("""
             ST_Transform(
                 ST_SetSRID(
-                    ST_FlipCoordinates(
-                        ST_GeomFromWKT(
-                            concat('POINT(', `prg-ad:pozycja`.`gml:Point`.`gml:pos`, ')')
-                        )
+                    ST_Point(
+                        CAST(_pos[1] AS DOUBLE),
+                        CAST(_pos[0] AS DOUBLE)
                     ),
                     2180
                 ),
                 'EPSG:4326'
             )
         """))
-        .drop("prg-ad:pozycja")
+        .drop("_pos", "prg-ad:pozycja")
     )
 
 
@@ -174,14 +241,119 @@ def select_cols_for_osmpoland(df: DataFrame) -> DataFrame:
             f.col("gml:identifier"),
             f.col("prg-ad:komponent").alias("komponent"),
             f.col("prg-ad:obiektEMUiA").alias("obiektEMUiA"),
-            f.col("prg-ad:cyklZycia.bt:BT_CyklZyciaInfo.bt:poczatekWersjiObiektu").alias("poczatekWersjiObiektu"),
-            f.col("prg-ad:cyklZycia.bt:BT_CyklZyciaInfo.bt:koniecWersjiObiektu").alias("koniecWersjiObiektu"),
+            f.to_date("prg-ad:cyklZycia.bt:BT_CyklZyciaInfo.bt:poczatekWersjiObiektu").alias("poczatekWersjiObiektu"),
+            f.to_date("prg-ad:cyklZycia.bt:BT_CyklZyciaInfo.bt:koniecWersjiObiektu").alias("koniecWersjiObiektu"),
             f.col("prg-ad:waznyOd").alias("waznyOd"),
             f.col("prg-ad:waznyDo").alias("waznyDo"),
         )
     )
 
 
+def cluster_by_location(df: DataFrame, num_partitions: int) -> DataFrame:
+    # nearby addresses end up in the same files and row groups so their min/max statistics
+    # are tight and readers can skip row groups when querying by location.
+    # partitions are made by hashing powiat name (third administrative unit) which is spatially compact
+    # and has ~380 values so all cores get work, voivodeship (16 values) would leave most of them idle,
+    # repartitionByRange would need a sampling job that evaluates whole xml parsing and ST_Transform twice
+    return (
+        df
+        .withColumn("_geohash", f.expr(f"ST_GeoHash(geometry, {GEOHASH_PRECISION})"))
+        .repartition(num_partitions, f.col("prg-ad:jednostkaAdmnistracyjna")[2])
+        .sortWithinPartitions("_geohash")
+        .drop("_geohash")
+    )
+
+
+def class_name(jvm_object) -> str:
+    return jvm_object.getClass().getName().rsplit(".", 1)[-1]
+
+
+def find_python_udfs(plan) -> List[str]:
+    # walks the jvm logical plan and all expressions in it, scala Seqs are accessed by index through py4j
+    found = []
+    plans = [plan]
+    while plans:
+        node = plans.pop()
+        name = class_name(node)
+        if name in PYTHON_PLAN_NODES:
+            found.append(name)
+        expressions = node.expressions()
+        exprs = [expressions.apply(i) for i in range(expressions.size())]
+        while exprs:
+            expr = exprs.pop()
+            name = class_name(expr)
+            if name in PYTHON_EXPRESSIONS:
+                found.append(f"{name}({expr.prettyName()})")
+            children = expr.children()
+            exprs.extend(children.apply(i) for i in range(children.size()))
+        children = node.children()
+        plans.extend(children.apply(i) for i in range(children.size()))
+    return found
+
+
+def assert_no_python_udfs(df: DataFrame) -> None:
+    # geometry processing has to stay in Sedona SQL functions (f.expr) which run in JVM,
+    # python udfs on geometries are orders of magnitude slower because of serialization
+    found = find_python_udfs(df._jdf.queryExecution().optimizedPlan())
+    if found:
+        raise ValueError(f"Query plan contains python udfs: {found}, use Spark/Sedona SQL functions instead.")
+
+
+def merge_geo_metadata(metadata: List[dict]) -> dict:
+    # every part file has its own bbox and geometry types in "geo" metadata so we need to union them
+    merged = deepcopy(metadata[0])
+    for column_name, column in merged["columns"].items():
+        bboxes = [m["columns"][column_name]["bbox"] for m in metadata if "bbox" in m["columns"][column_name]]
+        if bboxes:
+            column["bbox"] = [
+                min(b[0] for b in bboxes),
+                min(b[1] for b in bboxes),
+                max(b[2] for b in bboxes),
+                max(b[3] for b in bboxes),
+            ]
+        column["geometry_types"] = sorted({t for m in metadata for t in m["columns"][column_name]["geometry_types"]})
+    return merged
+
+
+def count_parquet_rows(files: List[Path]) -> int:
+    # only reads file footers
+    return sum(pq.read_metadata(path).num_rows for path in files)
+
+
+def merge_parquet_files(files: List[Path], to: Path) -> None:
+    print(f"Merging {len(files)} parquet files into:", to)
+    # spark writes timestamps as INT96 which pyarrow reads as nanoseconds by default,
+    # that overflows for old dates (before 1677) so we read them as microseconds
+    parts = [pq.ParquetFile(path, coerce_int96_timestamp_unit="us") for path in files]
+    # INT96 timestamps are UTC instants but pyarrow reads them as tz-naive so we mark them as UTC again
+    schema = pa.schema(
+        [
+            field.with_type(pa.timestamp("us", tz="UTC")) if pa.types.is_timestamp(field.type) else field
+            for field in parts[0].schema_arrow
+        ],
+        metadata=parts[0].schema_arrow.metadata,
+    )
+    geo_metadata = merge_geo_metadata([json.loads(part.schema_arrow.metadata[b"geo"]) for part in parts])
+    schema = schema.with_metadata({**schema.metadata, b"geo": json.dumps(geo_metadata).encode("utf-8")})
+    # merged file is written with the same encoding settings as spark uses for the parts,
+    # row groups are copied one by one so their size stays as spark wrote them
+    with pq.ParquetWriter(
+        to,
+        schema,
+        compression="zstd",
+        use_dictionary=True,
+        data_page_size=PARQUET_PAGE_SIZE,
+        dictionary_pagesize_limit=PARQUET_DICTIONARY_PAGE_SIZE,
+    ) as writer:
+        for part in parts:
+            for i in range(part.num_row_groups):
+                # stream every row group as a single record batch so we never hold more than one in memory
+                row_group_rows = part.metadata.row_group(i).num_rows
+                for batch in part.iter_batches(batch_size=row_group_rows, row_groups=[i], use_threads=True):
+                    writer.write_batch(batch.cast(schema), row_group_size=row_group_rows)
+    print("Finished merging parquet files.")
+
+
 if __name__ == "__main__":
     if len(argv) == 1:
         raise AttributeError(f"Need to provide execution parameter: {MODES}")
@@ -189,28 +361,29 @@ if __name__ == "__main__":
     if mode not in MODES:
         raise ValueError(f"mode: {mode} not one of: {MODES}")
 
-    xml_paths = f"{xml_dir}/*.xml"
+    xml_paths = f"{xml_split_dir}/*.xml"
     print("Starting parsing xml files:", xml_paths)
     spark = get_sedona_context()
 
-    df = read_xml(spark=spark, path=xml_paths)
+    df = read_xml(spark=spark, path=xml_paths, schema=get_schema(mode=mode))
+    # all row filters have to be applied before parsing geometry so ST_Transform runs only on rows we keep,
+    # osmpoland export keeps closed and planned addresses (with their status and validity columns) so it's not filtered.
+    # Catalyst combines these filters and projections into a single stage, geometry is computed by Sedona in JVM
+    # instead of e.g. pyproj in mapInArrow which would serialize every row to python and back
     if mode == MODE_OVERTURE:
-        df = remove_unneeded_ids(df=df)
         df = remove_closed_objects(df=df)
         df = remove_planned_addresses(df=df)
+        df = remove_objects_without_position(df=df)
     df = parse_point_geometry(df=df)
+    df = cluster_by_location(df=df, num_partitions=spark.sparkContext.defaultParallelism)
 
     if mode == MODE_OVERTURE:
-        df = select_cols_for_overture(df=df).cache()
+        df = select_cols_for_overture(df=df)
     elif mode == MODE_OSMPOLAND:
-        df = select_cols_for_osmpoland(df=df).cache()
+        df = select_cols_for_osmpoland(df=df)
     else:
         raise ValueError(f"Unknown mode: {mode}, should be one of: {MODES}")
-
-    num_rows = df.count()
-    print(f"Data has: {num_rows} rows.")
-    if num_rows == 0:
-        raise ValueError("No data to write.")
+    assert_no_python_udfs(df=df)
 
     output_path = geoparquet_dir.absolute().as_posix()
     print("Writing geoparquet files to:", output_path)
@@ -315,14 +488,30 @@ if __name__ == "__main__":
           "type": "GeographicCRS"
         }
     )
-    # write geoparquet
+    # write geoparquet in parallel, coalesce(1) would do all the work (including ST_Transform) on a single core
     (
         df
-        .coalesce(1)  # we want 1 result file
         .write
         .format("geoparquet")
         .option("geoparquet.version", "1.0.0")
         .option("geoparquet.crs", projjson)
+        .option("maxRecordsPerFile", MAX_RECORDS_PER_FILE)
+        .option("parquet.block.size", str(PARQUET_ROW_GROUP_SIZE))  # bigger row groups compress better
+        .option("parquet.page.size", str(PARQUET_PAGE_SIZE))
+        # low cardinality columns like place, postal code or status are dictionary encoded
+        .option("parquet.enable.dictionary", "true")
+        .option("parquet.dictionary.page.size", str(PARQUET_DICTIONARY_PAGE_SIZE))
         .save(path=output_path, mode="overwrite", compression="zstd")
     )
     print("Finished writing geoparquet files.")
+
+    # row count comes from parquet footers so we don't have to cache the data and scan it twice,
+    # it's checked before merging so we don't produce an empty result file
+    part_files = sorted(geoparquet_dir.glob("part*.parquet"))
+    num_rows = count_parquet_rows(files=part_files)
+    print(f"Data has: {num_rows} rows.")
+    if num_rows == 0:
+        raise ValueError("No data was written.")
+    # we want 1 result file so merge the parts afterwards which is cheap compared to computing them,
+    # parts are merged in order of partitions so rows within every partition stay ordered by location
+    merge_parquet_files(files=part_files, to=merged_geoparquet_path)
@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import sedona.db
+
+from parse_xml_arrow import parse_xml_files, parsed_xml_dir, xml_split_dir
+
+
+# Single node alternative to `process_gml.py overture` using SedonaDB instead of Spark.
+# PRG dataset is a few million rows so it fits on one machine and we can skip JVM startup and Spark scheduling.
+
+this_file = Path(__file__)
+this_dir = this_file.parent
+output_path = this_dir / "data_geoparquet" / "addresses.parquet"
+
+QUERY = """
+    SELECT
+        przestrzenNazw AS id_namespace,
+        lokalnyId AS unique_id,
+        wersjaId AS object_timestamp,
+        jednostkaAdmnistracyjna AS administrative_units,
+        miejscowosc AS place,
+        czescMiejscowosci AS place_part,
+        ulica AS street,
+        numerPorzadkowy AS housenumber,
+        kodPocztowy AS postal_code,
+        ST_Transform(
+            ST_SetSRID(
+                ST_Point(x, y),
+                2180
+            ),
+            'EPSG:4326'
+        ) AS geometry
+    FROM addresses
+    WHERE koniecWersjiObiektu IS NULL  -- in case any object is marked as closed
+        AND waznyDo IS NULL
+        AND status != 'prognozowany'
+        AND x IS NOT NULL
+"""
+
+
+if __name__ == "__main__":
+    # sedonadb can't read xml so we convert it to parquet first
+    num_rows = parse_xml_files(paths=sorted(xml_split_dir.glob("*.xml")), to=parsed_xml_dir)
+    if num_rows == 0:
+        raise ValueError("No data to write.")
+
+    sd = sedona.db.connect()
+    sd.read_parquet([p.absolute().as_posix() for p in sorted(parsed_xml_dir.glob("*.parquet"))]).to_view("addresses")
+    df = sd.sql(QUERY)
+
+    print("Writing geoparquet file to:", output_path)
+    df.to_parquet(output_path.absolute().as_posix())
+    print("Finished writing geoparquet file.")